@@ -2,14 +2,20 @@ import re
 import json
 import requests
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
 import urllib.parse
 import os
+import shutil
 import threading
+import functools
+import random
 from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
+from tqdm.utils import CallbackIOWrapper
 import time
 import argparse
-from fetch_all_models import fetch_all_models
+from fetch_all_models import fetch_all_models, json_loads, make_session
 import sys
 
 # Constants
@@ -17,12 +23,36 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 LOG_FILE_PATH = os.path.join(SCRIPT_DIR, "civitAI_Model_downloader.txt")
 OUTPUT_DIR = "model_downloads"
 MAX_PATH_LENGTH = 200
+WRITE_BUFFER_SIZE = 1024 * 1024  # Coalesce small chunk writes into fewer write syscalls
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # Bytes read from the response per copy step
+MAX_RETRY_DELAY = 120  # Upper bound in seconds for the retry backoff
 VALID_DOWNLOAD_TYPES = ['Lora', 'Checkpoints', 'Embeddings', 'Training_Data', 'Other', 'All']
 BASE_URL = "https://civitai.com/api/v1/models"
+# Download subfolder for a file, keyed by (file extension, model type); falls back to the extension default, then 'Other'
+SUBFOLDER_BY_EXTENSION_AND_TYPE = {
+    ('.zip', 'LORA'): 'Lora',
+    ('.zip', 'Training_Data'): 'Training_Data',
+    ('.safetensors', 'Checkpoint'): 'Checkpoints',
+    ('.safetensors', 'TextualInversion'): 'Embeddings',
+    ('.safetensors', 'VAE'): 'Other',
+    ('.safetensors', 'LoCon'): 'Other',
+    ('.pt', 'TextualInversion'): 'Embeddings',
+}
+DEFAULT_SUBFOLDER_BY_EXTENSION = {'.safetensors': 'Lora'}
+SUMMARY_COUNT_PATTERN = re.compile(r'^(.+?) - Count:\s*(\d+)\s*$', re.MULTILINE)  # "<category or Total> - Count: <n>"
+# Runs of problematic characters, control characters and underscores, each collapsed into a single underscore
+INVALID_CHAR_RUNS_PATTERN = re.compile(r'[<>:"/\\|?*\x00-\x1f\x7f-\x9f_]+')
+RESERVED_NAMES = frozenset({"CON", "PRN", "AUX", "NUL"} | {f"COM{i}" for i in range(1, 10)} | {f"LPT{i}" for i in range(1, 10)})  # Windows specific
 
 # Logging configuration
 logging.basicConfig(filename=LOG_FILE_PATH, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', encoding='utf-8')
 logger = logging.getLogger(__name__)
+# Download failures go to <username>.download_errors.log; worker threads only enqueue records
+# and one listener per username writes them, so the log file is opened once instead of per failure
+download_errors_queue = queue.Queue()
+download_errors_logger = logging.getLogger(f"{__name__}.download_errors")
+download_errors_logger.propagate = False
+download_errors_logger.addHandler(QueueHandler(download_errors_queue))
 
 # Argument parsing
 parser = argparse.ArgumentParser(description="Download model files and images from Civitai API.")
@@ -53,8 +83,29 @@ def sanitize_directory_name(name):
 OUTPUT_DIR = sanitize_directory_name(OUTPUT_DIR)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-# Create session
-session = requests.Session()
+# Create session with a connection pool large enough for every download thread plus the API requests,
+# so keep-alive connections are reused instead of being discarded and re-handshaken. The listing pass in
+# fetch_all_models uses it too, so --max_tries and --retry_delay govern its retries as well.
+# The token is sent as an Authorization header to civitai.com requests only, instead of in each URL, which keeps
+# it out of details.txt and the logs; image hosts and the storage URLs downloads redirect to never receive it.
+session = make_session(total=max_tries, backoff_factor=retry_delay / 2, pool_maxsize=max_threads * 2, token=token)
+
+# Directories already created during this run, shared by all download threads
+created_dirs = set()
+created_dirs_lock = threading.Lock()
+
+# Serialize the read-compare-append of details.txt; versions of one model share the same file.
+# Files are spread over several locks by path so unrelated models do not wait on each other.
+DETAILS_LOCK_SHARDS = 64
+details_locks = [threading.Lock() for _ in range(DETAILS_LOCK_SHARDS)]
+
+# Keeps the entries of different download threads in failed_downloads_<username>.txt from interleaving
+failed_downloads_lock = threading.Lock()
+
+# One byte counter for all concurrent downloads instead of a progress bar per file;
+# it only appears once a download has been running for a second and redraws at most twice a second
+download_progress = tqdm(desc="Downloaded", unit='B', unit_scale=True, delay=1, mininterval=0.5)
+download_progress_lock = threading.Lock()
 
 # Validate download type
 if args.download_type:
@@ -77,17 +128,17 @@ def read_summary_data(username):
     data = {}
     try:
         with open(summary_path, 'r', encoding='utf-8') as file:
-            for line in file:
-                if 'Total - Count:' in line:
-                    total_count = int(line.strip().split(':')[1].strip())
-                    data['Total'] = total_count
-                elif ' - Count:' in line:
-                    category, count = line.strip().split(' - Count:')
-                    data[category.strip()] = int(count.strip())
+            text = file.read()
+        # The detailed listing only repeats the summary counts, followed by one line per item
+        summary = text.split('Detailed Listing:', 1)[0]
+        for match in SUMMARY_COUNT_PATTERN.finditer(summary):
+            data[match.group(1).strip()] = int(match.group(2))
     except FileNotFoundError:
         print(f"File {summary_path} not found.")
     return data
 
+# The same item and version names are sanitized for every file and image of a version
+@functools.lru_cache(maxsize=4096)
 def sanitize_name(name, folder_name=None, max_length=MAX_PATH_LENGTH, subfolder=None, output_dir=None, username=None):
     """Sanitize a name for use as a file or folder name."""
     base_name, extension = os.path.splitext(name)
@@ -98,16 +149,15 @@ def sanitize_name(name, folder_name=None, max_length=MAX_PATH_LENGTH, subfolder=
     if folder_name:
         base_name = base_name.replace(folder_name, "").strip("_")
 
-    # Remove problematic characters and control characters
-    base_name = re.sub(r'[<>:"/\\|?*\x00-\x1f\x7f-\x9f]', '_', base_name)
+    # Replace problematic and control characters and reduce multiple underscores to single, in one pass
+    base_name = INVALID_CHAR_RUNS_PATTERN.sub('_', base_name)
 
     # Handle reserved names (Windows specific)
-    reserved_names = {"CON", "PRN", "AUX", "NUL"} | {f"COM{i}" for i in range(1, 10)} | {f"LPT{i}" for i in range(1, 10)}
-    if base_name.upper() in reserved_names:
+    if base_name.upper() in RESERVED_NAMES:
         base_name = '_'
 
-    # Reduce multiple underscores to single and trim leading/trailing underscores and dots
-    base_name = re.sub(r'__+', '_', base_name).strip('_.')
+    # Trim leading/trailing underscores and dots
+    base_name = base_name.strip('_.')
     
     # Calculate max length of base name considering the path length
     if subfolder and output_dir and username:
@@ -119,147 +169,174 @@ def sanitize_name(name, folder_name=None, max_length=MAX_PATH_LENGTH, subfolder=
     return sanitized_name.strip()
 
 
-def download_file_or_image(url, output_path, retry_count=0, max_retries=max_tries):
+def ensure_dir(path):
+    """Create a directory once per run; later calls for the same path skip the filesystem."""
+    with created_dirs_lock:
+        if path in created_dirs:
+            return
+        os.makedirs(path, exist_ok=True)
+        created_dirs.add(path)
+
+def add_query_params(url, **params):
+    """Return the URL with the given query parameters set, replacing any values it already carries."""
+    parts = urllib.parse.urlsplit(url)
+    query = [(key, value) for key, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True) if key not in params]
+    query.extend(params.items())
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+def advance_download_progress(size):
+    """Add downloaded bytes to the shared progress bar; its counter is not safe to update from several threads."""
+    with download_progress_lock:
+        download_progress.update(size)
+
+def download_file_or_image(url, output_path, max_retries=max_tries):
     """Download a file or image from the provided URL."""
     # Check if the file already exists
     if os.path.exists(output_path):
         return False
-    
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    progress_bar = None
+
+    ensure_dir(os.path.dirname(output_path))
+    # Download into a temporary file and move it into place only once it is complete,
+    # so an interrupted or undersized download is never mistaken for a finished file
+    temp_path = output_path + '.tmp'
+    error = None
     try:
-        response = session.get(url, stream=True, timeout=(20, 40))
-        if response.status_code == 404:
-            print(f"File not found: {url}")
-            return False
-        response.raise_for_status()
-        total_size = int(response.headers.get('content-length', 0))
-        progress_bar = tqdm(total=total_size, unit='B', unit_scale=True, leave=False)
-        with open(output_path, "wb") as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    progress_bar.update(len(chunk))
-                    file.write(chunk)
-        progress_bar.close()
-        if output_path.endswith('.safetensor') and os.path.getsize(output_path) < 4 * 1024 * 1024:  # 4MB
-            if retry_count < max_retries:
-                print(f"File {output_path} is smaller than expected. Try to download again (attempt {retry_count}).")
-                time.sleep(retry_delay)
-                return download_file_or_image(url, output_path, retry_count + 1, max_retries)
-            else:
-                download_errors_log = os.path.join(SCRIPT_DIR, f'{username}.download_errors.log')
-                with open(download_errors_log, 'a', encoding='utf-8') as log_file:
-                    log_file.write(f"Failed to download {url} after {max_retries} attempts.\n")
-                return False
-        return True
-    except (requests.RequestException, Exception)as e:
-        if retry_count < max_retries:
-            print(f"Error downloading {url}: {e}. Retrying in {retry_delay} seconds (attempt {retry_count}).")
-            time.sleep(retry_delay)
-            return download_file_or_image(url, output_path, retry_count + 1, max_retries)
-        else:
-            download_errors_log = os.path.join(SCRIPT_DIR, f'{username}.download_errors.log')
-            with open(download_errors_log, 'a', encoding='utf-8') as log_file:
-                log_file.write(f"Failed to download {url} after {max_retries} attempts. Error: {e}\n")
-            return False
-    except (requests.RequestException, TimeoutError, ConnectionResetError) as e:
-        if progress_bar:
-            progress_bar.close()
-        if retry_count < max_retries:
-            print(f"Error during download: {url}, attempt {retry_count + 1}")
-            time.sleep(retry_delay)
-            return download_file_or_image(url, output_path, retry_count + 1, max_retries)
-        else:
-            download_errors_log = os.path.join(SCRIPT_DIR, f'{username}.download_errors.log')
-            with open(download_errors_log, 'a', encoding='utf-8') as log_file:
-                log_file.write(f"Error downloading file {output_path} from URL {url}: {e} after {max_retries} attempts\n")
-            return False
-    return True
-
-def download_model_files(item_name, model_version, item, download_type, failed_downloads_file):
-    """Download related image and model files for each model version."""
+        for attempt in range(max_retries + 1):
+            if attempt:
+                # Back off exponentially so repeated failures do not hammer a rate-limited host;
+                # the jitter keeps threads that failed together from retrying in lockstep
+                delay = min(retry_delay * 2 ** (attempt - 1), MAX_RETRY_DELAY) + random.uniform(0, 1)
+                print(f"Retrying {url} in {delay:.1f} seconds (attempt {attempt}).")
+                time.sleep(delay)
+            try:
+                # Close the streamed response on every exit path so its connection goes back to the session pool
+                with session.get(url, stream=True, timeout=(20, 40)) as response:
+                    if response.status_code == 404:
+                        print(f"File not found: {url}")
+                        return False
+                    response.raise_for_status()
+                    # Read the raw stream directly; decode_content keeps gzip/deflate bodies transparent
+                    response.raw.decode_content = True
+                    with open(temp_path, "wb", buffering=WRITE_BUFFER_SIZE) as file:
+                        shutil.copyfileobj(CallbackIOWrapper(advance_download_progress, response.raw, 'read'), file, DOWNLOAD_CHUNK_SIZE)
+                        size = file.tell()  # Bytes written, including what is still buffered; no stat needed
+                if output_path.endswith('.safetensor') and size < 4 * 1024 * 1024:  # 4MB
+                    error = "file is smaller than expected"
+                    print(f"File {output_path} is smaller than expected (attempt {attempt}).")
+                    continue
+                os.replace(temp_path, output_path)
+                return True
+            except requests.RequestException as e:
+                # Connection errors and 429/5xx responses were already retried by the session adapter
+                error = e
+                print(f"Error downloading {url}: {e}")
+                break
+            except Exception as e:
+                # The body stream broke off mid-download; start the file over
+                error = e
+                print(f"Error downloading {url}: {e}")
+    finally:
+        # Already moved into place on success; only a failed attempt leaves it behind
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+
+    # Request errors stop after the first attempt, so report how many were actually made
+    download_errors_logger.error(f"Failed to download {url} after {attempt + 1} attempt(s). Error: {error}")
+    return False
+
+def write_details(details_lines):
+    """Append the collected details.txt lines, opening each file only once.
+
+    Entries that are already in the file from an earlier run are not written again.
+    """
+    for details_file, lines in details_lines.items():
+        with details_locks[hash(details_file) % DETAILS_LOCK_SHARDS]:
+            try:
+                with open(details_file, "r", encoding='utf-8') as f:
+                    existing = "\n" + f.read()
+            except FileNotFoundError:
+                existing = ""
+            new_lines = [line for line in lines if "\n" + line not in existing]
+            if new_lines:
+                with open(details_file, "a", encoding='utf-8') as f:
+                    f.writelines(new_lines)
+
+def write_failed_downloads(failed_downloads, entries):
+    """Append the failed download entries of one model version to the open failed downloads file."""
+    if entries:
+        with failed_downloads_lock:
+            failed_downloads.writelines(entries)
+
+def download_model_files(item_name, item_name_sanitized, model_version, item, download_type, failed_downloads):
+    """Download related image and model files for each model version.
+
+    Returns the item name, whether anything was downloaded and the item directories used.
+    """
     files = model_version.get('files', [])
     images = model_version.get('images', [])
     downloaded = False
     model_id = item['id']
     model_url = f"https://civitai.com/models/{model_id}"
-    item_name_sanitized = sanitize_name(item_name, max_length=MAX_PATH_LENGTH)
-    model_images = {}
     item_dir = None
+    # details.txt lines per file path, written in one go once the version is done
+    details_lines = {}
+    # Item directory per subfolder; the files of a version usually all share one
+    item_dirs = {}
+    # Names already present in each item directory, listed once instead of a stat per file
+    existing_names = {}
+    # failed_downloads entries, written together when the version is done
+    failed_entries = []
 
     for file in files:
         file_name = file.get('name', '')
         file_url = file.get('downloadUrl', '')
 
-        if file_name.endswith('.zip'):
-            if 'type' in item and item['type'] == 'LORA':
-                subfolder = 'Lora'
-            elif 'type' in item and item['type'] == 'Training_Data':
-                subfolder = 'Training_Data'
-            else:
-                subfolder = 'Other'
-        elif file_name.endswith('.safetensors'):
-            if 'type' in item:
-                if item['type'] == 'Checkpoint':
-                    subfolder = 'Checkpoints'
-                elif item['type'] == 'TextualInversion':
-                    subfolder = 'Embeddings'
-                elif item['type'] in ['VAE', 'LoCon']:
-                    subfolder = 'Other'
-                else:
-                    subfolder = 'Lora'
-            else:
-                subfolder = 'Lora'
-        elif file_name.endswith('.pt'):
-            if 'type' in item and item['type'] == 'TextualInversion':
-                subfolder = 'Embeddings'
-            else:
-                subfolder = 'Other'
-        else:
-            subfolder = 'Other'
+        if not file_name or not file_url:
+            print(f"Invalid file entry: {file}")
+            continue
+
+        extension = os.path.splitext(file_name)[1]
+        subfolder = SUBFOLDER_BY_EXTENSION_AND_TYPE.get((extension, item.get('type')), DEFAULT_SUBFOLDER_BY_EXTENSION.get(extension, 'Other'))
 
         if download_type != 'All' and download_type != subfolder:
             continue
 
-        item_dir = os.path.join(OUTPUT_DIR, username, subfolder, item_name_sanitized)
-        try:
-            os.makedirs(item_dir, exist_ok=True)
-        except OSError as e:
-            with open(failed_downloads_file, "a", encoding='utf-8') as f:
-                f.write(f"Item Name: {item_name}\n")
-                f.write(f"Model URL: {model_url}\n")
-                f.write("---\n")
-            return item_name, False, model_images
-
-        if '?' in file_url:
-            file_url += f"&token={token}&nsfw=true"
-        else:
-            file_url += f"?token={token}&nsfw=true"
+        item_dir = item_dirs.get(subfolder)
+        if item_dir is None:
+            item_dir = os.path.join(OUTPUT_DIR, username, subfolder, item_name_sanitized)
+            try:
+                ensure_dir(item_dir)
+            except OSError as e:
+                failed_entries.append(f"Item Name: {item_name}\nModel URL: {model_url}\n---\n")
+                write_failed_downloads(failed_downloads, failed_entries)
+                write_details(details_lines)
+                return item_name, False, list(item_dirs.values())
+            item_dirs[subfolder] = item_dir
+            with os.scandir(item_dir) as entries:
+                existing_names[item_dir] = {entry.name for entry in entries}
 
         file_name_sanitized = sanitize_name(file_name, item_name, max_length=MAX_PATH_LENGTH, subfolder=subfolder)
+        # Files from an earlier run are kept as they are and not reported as failures;
+        # their details were recorded when they were downloaded
+        if file_name_sanitized in existing_names[item_dir]:
+            continue
         file_path = os.path.join(item_dir, file_name_sanitized)
 
-        if not file_name or not file_url:
-            print(f"Invalid file entry: {file}")
-            continue
+        file_url = add_query_params(file_url, nsfw='true')
 
-        success = download_file_or_image(file_url, file_path)
-        if success:
+        if download_file_or_image(file_url, file_path):
             downloaded = True
         else:
-            with open(failed_downloads_file, "a", encoding='utf-8') as f:
-                f.write(f"Item Name: {item_name}\n")
-                f.write(f"File URL: {file_url}\n")
-                f.write("---\n")
+            failed_entries.append(f"Item Name: {item_name}\nFile URL: {file_url}\n---\n")
 
-        
         details_file = sanitize_directory_name(os.path.join(item_dir, "details.txt"))
-        with open(details_file, "a", encoding='utf-8') as f:
-            f.write(f"Model URL: {model_url}\n")
-            f.write(f"File Name: {file_name}\n")
-            f.write(f"File URL: {file_url}\n")
+        details_lines.setdefault(details_file, []).append(f"Model URL: {model_url}\nFile Name: {file_name}\nFile URL: {file_url}\n")
 
     if item_dir is not None:
+        details_file = sanitize_directory_name(os.path.join(item_dir, "details.txt"))
+        existing_images = existing_names[item_dir]
         for image in images:
             image_id = image.get('id', '')
             image_url = image.get('url', '')
@@ -271,114 +348,143 @@ def download_model_files(item_name, model_version, item, download_type, failed_d
                 print(f"Invalid image entry: {image}")
                 continue
 
-            success = download_file_or_image(image_url, image_path)
-            if success:
-                downloaded = True
-            else:
-                with open(failed_downloads_file, "a", encoding='utf-8') as f:
-                    f.write(f"Item Name: {item_name}\n")
-                    f.write(f"Image URL: {image_url}\n")
-                    f.write("---\n")
-
-            details_file = sanitize_directory_name(os.path.join(item_dir, "details.txt"))
-            with open(details_file, "a", encoding='utf-8') as f:
-                f.write(f"Image ID: {image_id}\n")
-                f.write(f"Image URL: {image_url}\n")
-
-    return item_name, downloaded, model_images
-
-def process_username(username, download_type):
-    """Process a username and download the specified type of content."""
-    print(f"Processing username: {username}, Download type: {download_type}")
-    fetch_user_data = fetch_all_models(token, username)
-    summary_data = read_summary_data(username)
-    total_items = summary_data.get('Total', 0)
+            if image_filename_sanitized not in existing_images:
+                if download_file_or_image(image_url, image_path):
+                    downloaded = True
+                else:
+                    failed_entries.append(f"Item Name: {item_name}\nImage URL: {image_url}\n---\n")
 
-    if download_type == 'All':
-        selected_type_count = total_items
-        intentionally_skipped = 0
-    else:
-        selected_type_count = summary_data.get(download_type, 0)
-        intentionally_skipped = total_items - selected_type_count
+            details_lines.setdefault(details_file, []).append(f"Image ID: {image_id}\nImage URL: {image_url}\n")
 
-    params = {
-        "username": username,
-        "token": token
-    }
-    url = f"{BASE_URL}?{urllib.parse.urlencode(params)}&nsfw=true"
+    write_failed_downloads(failed_downloads, failed_entries)
+    write_details(details_lines)
+    return item_name, downloaded, list(item_dirs.values())
 
+def iter_pages(url):
+    """Yield the items of each API page, following metadata.nextPage from the given first page."""
     headers = {
         "Content-Type": "application/json"
     }
-
-    failed_downloads_file = os.path.join(SCRIPT_DIR, f"failed_downloads_{username}.txt")
-    with open(failed_downloads_file, "w", encoding='utf-8') as f:
-        f.write(f"Failed Downloads for Username: {username}\n\n")
-
-    initial_url = url
     next_page = url
-    first_next_page = None
-
-    while True:
-        if next_page is None:
-            print("End of pagination reached: 'next_page' is None.")
-            break
-
-        retry_count = 0
-        max_retries = max_tries
-        retry_delay = args.retry_delay
 
-        while retry_count < max_retries:
+    while next_page is not None:
+        for attempt in range(max_tries + 1):
+            if attempt:
+                print(f"Retrying in {retry_delay} seconds...")
+                time.sleep(retry_delay)
             try:
-                response = session.get(next_page, headers=headers)
+                response = session.get(next_page, headers=headers, timeout=(10, 30))
                 response.raise_for_status()
-                data = response.json()
+            except (requests.RequestException, TimeoutError) as e:
+                # Connection errors and 429/5xx responses were already retried by the session adapter
+                print(f"Error making API request: {e}")
+                print("Maximum retries exceeded. Exiting.")
+                exit()
+            try:
+                data = json_loads(response.content)
                 break  # Exit retry loop on successful response
-            except (requests.RequestException, TimeoutError, json.JSONDecodeError) as e:
-                print(f"Error making API request or decoding JSON response: {e}")
-                retry_count += 1
-                if retry_count < max_retries:
-                    print(f"Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
-                else:
-                    print("Maximum retries exceeded. Exiting.")
-                    exit()
+            except json.JSONDecodeError as e:
+                # A garbled body is not something the adapter retries, so the page is fetched again here
+                print(f"Error decoding JSON response: {e}")
+        else:
+            print("Maximum retries exceeded. Exiting.")
+            exit()
 
         items = data['items']
         metadata = data.get('metadata', {})
-        next_page = metadata.get('nextPage')
 
         if not metadata and not items:
             print("Termination condition met: 'metadata' is empty.")
-            break
-
-        if first_next_page is None:
-            first_next_page = next_page
-
-        executor = ThreadPoolExecutor(max_workers=max_threads)
-        download_futures = []
-        downloaded_item_names = set()
+            return
 
-        for item in items:
-            item_name = item['name']
-            model_versions = item['modelVersions']
-            if item_name in downloaded_item_names:
-                continue
-            downloaded_item_names.add(item_name)
+        yield items
+        next_page = metadata.get('nextPage')
 
-            for version in model_versions:
-                future = executor.submit(download_model_files, item_name, version, item, download_type, failed_downloads_file)
-                download_futures.append(future)
+    print("End of pagination reached: 'next_page' is None.")
 
-        for future in tqdm(download_futures, desc="Downloading Files", unit="file", leave=False):
-            future.result()
+def process_username(username, download_type):
+    """Process a username and download the specified type of content."""
+    print(f"Processing username: {username}, Download type: {download_type}")
+    fetch_user_data = fetch_all_models(username, session)
+    summary_data = read_summary_data(username)
+    total_items = summary_data.get('Total', 0)
 
-        executor.shutdown()
-    
     if download_type == 'All':
-        downloaded_count = sum(len(os.listdir(os.path.join(OUTPUT_DIR, username, category))) for category in ['Lora', 'Checkpoints', 'Embeddings', 'Training_Data', 'Other'] if os.path.exists(os.path.join(OUTPUT_DIR, username, category)))
+        selected_type_count = total_items
+        intentionally_skipped = 0
     else:
-        downloaded_count = len(os.listdir(os.path.join(OUTPUT_DIR, username, download_type))) if os.path.exists(os.path.join(OUTPUT_DIR, username, download_type)) else 0
+        selected_type_count = summary_data.get(download_type, 0)
+        intentionally_skipped = total_items - selected_type_count
+
+    params = {
+        "username": username,
+        "nsfw": "true"
+    }
+    url = f"{BASE_URL}?{urllib.parse.urlencode(params)}"
+
+    failed_downloads_file = os.path.join(SCRIPT_DIR, f"failed_downloads_{username}.txt")
+    download_errors_handler = logging.FileHandler(os.path.join(SCRIPT_DIR, f'{username}.download_errors.log'), encoding='utf-8', delay=True)
+    download_errors_handler.setFormatter(logging.Formatter('%(message)s'))
+    download_errors_listener = QueueListener(download_errors_queue, download_errors_handler)
+    download_errors_listener.start()
+
+    try:
+        # Item folders are collected from the results instead of listing the category folders afterwards;
+        # only folders of the selected download type are ever created, so no per-type filtering is needed
+        item_dirs = set()
+        results_lock = threading.Lock()
+        # Limits how many versions are queued ahead of the workers, so pagination cannot run far ahead of the downloads
+        queued_versions = threading.BoundedSemaphore(max_threads * 4)
+
+        def collect_result(item_name, future):
+            """Record the folders of a finished version as soon as it is done, so no Future outlives its download."""
+            try:
+                # One broken version must not abort the remaining downloads of the username
+                try:
+                    _, _, version_item_dirs = future.result()
+                except Exception as e:
+                    print(f"Error processing a version of {item_name}: {e}")
+                    logger.error(f"Error processing a version of {item_name}: {e}")
+                    version_item_dirs = ()
+                with results_lock:
+                    item_dirs.update(version_item_dirs)
+                    versions_progress.update(1)
+            finally:
+                queued_versions.release()
+
+        # One pool for all pages: pagination keeps going while earlier pages are still downloading.
+        # The pool is shut down before the progress bar and the failed downloads file are closed,
+        # so every download thread and its result callback have finished by then.
+        with open(failed_downloads_file, "w", encoding='utf-8') as failed_downloads, \
+                tqdm(total=0, desc="Downloading Files", unit="file", leave=False) as versions_progress, \
+                ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix='civitai-dl') as executor:
+            failed_downloads.write(f"Failed Downloads for Username: {username}\n\n")
+
+            for items in iter_pages(url):
+                downloaded_item_names = set()
+
+                for item in items:
+                    item_name = item['name']
+                    model_versions = item['modelVersions']
+                    if item_name in downloaded_item_names:
+                        continue
+                    downloaded_item_names.add(item_name)
+                    # The folder name is the same for every version of the item
+                    item_name_sanitized = sanitize_name(item_name, max_length=MAX_PATH_LENGTH)
+
+                    for version in model_versions:
+                        queued_versions.acquire()
+                        with results_lock:
+                            # The bar grows with every submitted version, since the total is only known after the last page
+                            versions_progress.total += 1
+                        future = executor.submit(download_model_files, item_name, item_name_sanitized, version, item, download_type, failed_downloads)
+                        future.add_done_callback(functools.partial(collect_result, item_name))
+    finally:
+        # Write out the queued download errors before the next username reuses the queue
+        download_errors_listener.stop()
+        download_errors_handler.close()
+
+    downloaded_count = len(item_dirs)
 
     failed_count = selected_type_count - downloaded_count
 
@@ -388,5 +494,7 @@ def process_username(username, download_type):
     print(f"Failed items for username {username}: {failed_count}")
 
 if __name__ == "__main__":
-    for username in usernames:
-        process_username(username, download_type)
+    # The session and its warm connection pool are shared by all usernames and released once at the end
+    with session, download_progress:
+        for username in usernames:
+            process_username(username, download_type)
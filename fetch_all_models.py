@@ -1,7 +1,18 @@
+import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import logging
 import argparse
 import os
+import urllib.parse
+
+# orjson decodes the API pages considerably faster; it is optional and the standard library is used without it
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 # Setting up logger for errors only
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -9,33 +20,74 @@ file_path = os.path.join(script_dir, "fetch_all_models_ERROR_LOG.txt")
 logging.basicConfig(filename=file_path, level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Host that receives the API token; requests to any other host are sent without it
+API_HOST = "civitai.com"
+# Summary category per upper-cased model type; every other type is counted as 'Other'
+CATEGORY_BY_TYPE = {
+    'CHECKPOINT': 'Checkpoints',
+    'TEXTUALINVERSION': 'Embeddings',
+    'LORA': 'Lora',
+    'TRAINING_DATA': 'Training_Data',
+}
+
+class CivitaiTokenAuth(requests.auth.AuthBase):
+    """Send the API token as a Bearer header, but only to civitai.com itself.
+
+    Image and file storage URLs on other hosts never see it.
+    """
+    def __init__(self, token):
+        self.token = token
+
+    def __call__(self, request):
+        if urllib.parse.urlsplit(request.url).hostname == API_HOST:
+            request.headers['Authorization'] = f"Bearer {self.token}"
+        return request
+
+def make_session(total, backoff_factor, pool_maxsize=10, token=None):
+    """Create a keep-alive session that retries connection errors and 429/5xx responses.
+
+    Retries back off exponentially and honour Retry-After; once they run out the last response is returned as is.
+    With a token, requests to civitai.com are authenticated.
+    """
+    session = requests.Session()
+    if token:
+        session.auth = CivitaiTokenAuth(token)
+    retries = Retry(total=total, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504),
+                    allowed_methods=['GET'], respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_maxsize=pool_maxsize, pool_block=True, max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 def categorize_item(item):
     """Categorize the item based on JSON type."""
-    item_type = item.get("type", "").upper()
-    file_name = item.get("name", "")
-
-    if item_type == 'CHECKPOINT':
-        return 'Checkpoints'
-    elif item_type == 'TEXTUALINVERSION':
-        return 'Embeddings'
-    elif item_type == 'LORA':
-        return 'Lora'
-    elif item_type == 'TRAINING_DATA':
-        return 'Training_Data'
-    else:
-        return 'Other'
+    return CATEGORY_BY_TYPE.get(item.get("type", "").upper(), 'Other')
 
 def search_for_training_data_files(item):
     """Search for files with type 'Training Data' in the item's model versions."""
-    training_data_files = []
-    model_versions = item.get("modelVersions", [])
-    for version in model_versions:
-        for file in version.get("files", []):
-            if file.get("type") == "Training Data":
-                training_data_files.append(file.get("name", ""))
-    return training_data_files
-
-def fetch_all_models(token, username):
+    return [file.get("name", "") for version in item.get("modelVersions", ()) for file in version.get("files", ())
+            if file.get("type") == "Training Data"]
+
+def format_summary(categorized_items, other_item_types):
+    """Build the lines of the summary file: the counts per category followed by the detailed listing."""
+    total_count = sum(len(items) for items in categorized_items.values())
+    counts = [f"{category} - Count: {len(items)}\n" for category, items in categorized_items.items()]
+
+    lines = ["Summary:\n", f"Total - Count: {total_count}\n"]
+    lines.extend(counts)
+    lines.append("\nDetailed Listing:\n")
+
+    # The detailed listing
+    for (category, items), count in zip(categorized_items.items(), counts):
+        lines.append(count)
+        if category == 'Other':
+            lines.extend(f"{category} - Item: {item_name} - Type: {item_type}\n" for item_name, item_type in other_item_types)
+        else:
+            lines.extend(f"{category} - Item: {item_name}\n" for item_name in items)
+        lines.append("\n")
+    return lines
+
+def fetch_all_models(username, session):
     base_url = "https://civitai.com/api/v1/models"
     categorized_items = {
         'Checkpoints': [],
@@ -45,68 +97,68 @@ def fetch_all_models(token, username):
         'Other': []
     }
     other_item_types = []
+    training_data_items = categorized_items['Training_Data']
 
-    next_page = f"{base_url}?username={username}&token={token}&nsfw=true"
-    first_next_page = None
+    next_page = f"{base_url}?{urllib.parse.urlencode({'username': username, 'nsfw': 'true'})}"
+    # Every page URL requested so far; a nextPage pointing back to one of them would loop forever
+    seen_pages = {next_page}
 
     while next_page:
-        response = requests.get(next_page)
-        data = response.json()
+        response = session.get(next_page, timeout=(10, 30))
+        try:
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            # The session has already retried the page; a summary without the remaining pages
+            # would pass as complete, so no summary is written at all
+            logger.error(f"Error fetching models page: {e}")
+            raise
+        data = json_loads(response.content)
         for item in data.get("items", []):
             try:
+                item_name = item.get("name", "")
                 # Check for top-level categorization
                 category = categorize_item(item)
-                categorized_items[category].append(item.get("name", ""))
+                categorized_items[category].append(item_name)
                 
                 # Check for deep nested "Training Data" files
                 training_data_files = search_for_training_data_files(item)
                 if training_data_files:
-                    categorized_items['Training_Data'].extend(training_data_files)
+                    training_data_items.extend(training_data_files)
 
                 if category == 'Other':
-                    other_item_types.append((item.get("name", ""), item.get("type", None)))
+                    other_item_types.append((item_name, item.get("type", None)))
             except Exception as e:
                 logger.error(f"Error categorizing item: {item} - {e}")
 
         metadata = data.get('metadata', {})
         next_page = metadata.get('nextPage')
-        if first_next_page is None:
-            first_next_page = next_page
-        if next_page and next_page == first_next_page and next_page != next_page or not metadata:
-            logger.error("Termination condition met: first nextPage URL repeated.")
-            break    
-
-    total_count = sum(len(items) for items in categorized_items.values())
+        if not metadata:
+            logger.error("Termination condition met: 'metadata' is empty.")
+            break
+        if next_page in seen_pages:
+            logger.error("Termination condition met: nextPage URL repeated.")
+            break
+        seen_pages.add(next_page)
 
     # Write the summary
     file_path = os.path.join(script_dir, f"{username}.txt")
     with open(file_path, "w", encoding='utf-8') as file:
-        file.write("Summary:\n")
-        file.write(f"Total - Count: {total_count}\n")
-        for category, items in categorized_items.items():
-            file.write(f"{category} - Count: {len(items)}\n")
-        file.write("\nDetailed Listing:\n")
-
-        # Write the detailed listing
-        for category, items in categorized_items.items():
-            file.write(f"{category} - Count: {len(items)}\n")
-            if category == 'Other':
-                for item_name, item_type in other_item_types:
-                    file.write(f"{category} - Item: {item_name} - Type: {item_type}\n")
-            else:
-                for item_name in items:
-                    file.write(f"{category} - Item: {item_name}\n")
-            file.write("\n")
+        file.writelines(format_summary(categorized_items, other_item_types))
 
     return categorized_items
 
 def main():
     parser = argparse.ArgumentParser(description="Fetch and categorize models.")
     parser.add_argument("--token", type=str, help="API token.")
-    parser.add_argument("--username", type=str, help="Username to fetch models for.")
+    parser.add_argument("--username", type=str, action="append", required=True,
+                        help="Username to fetch models for; repeat to fetch several over the same connection.")
     args = parser.parse_args()
 
-    fetch_all_models(args.token, args.username)
+    # One session for all usernames, so the connection to the API is kept alive between them; the token rides
+    # in its civitai.com-only auth hook rather than the page URLs, their nextPage cursors or the error log
+    with make_session(total=5, backoff_factor=0.5, token=args.token) as session:
+        for username in args.username:
+            fetch_all_models(username, session)
 
 if __name__ == "__main__":
     main()